@@ -6,15 +6,15 @@
 
 import argparse
 import ctypes
+import functools
 import itertools
 import logging
 import multiprocessing as mp
 import pathlib
-import random
 import shutil
 import sys
 import time
-from typing import Dict, Tuple
+from typing import Any, Dict, Iterator, Tuple
 
 import hictkpy
 import numpy as np
@@ -105,31 +105,49 @@ def hictk_dump(file, query1: str, query2: str, normalization: str = "NONE") -> p
     return df.set_index(["chrom1", "start1", "end1", "chrom2", "start2", "end2"])[["count"]]
 
 
-def read_chrom_sizes_cooler(path_to_cooler_file: pathlib.Path) -> Dict[str, int]:
-    return cooler.Cooler(str(path_to_cooler_file)).chromsizes.to_dict()
-
+@functools.lru_cache(maxsize=8)
+def open_cooler(uri: str) -> cooler.Cooler:
+    return cooler.Cooler(uri)
 
-def generate_query_1d(chroms, weights: np.ndarray, mean_length: float, stddev_length: float) -> str:
-    chrom_name, chrom_size = random.choices(chroms, weights=weights, k=1)[0]
 
-    query_length = max(2.0, random.gauss(mu=mean_length, sigma=stddev_length))
+@functools.lru_cache(maxsize=8)
+def open_reference_cooler(uri: str, balance: str) -> Tuple[cooler.Cooler, Any]:
+    clr = open_cooler(uri)
+    sel = clr.matrix(balance=balance if balance != "NONE" else False, as_pixels=True, join=True)
+    return clr, sel
 
-    center_pos = random.randint(0, chrom_size)
-    start_pos = max(0.0, center_pos - (query_length / 2))
-    end_pos = min(chrom_size, start_pos + query_length)
 
-    return f"{chrom_name}:{start_pos:.0f}-{end_pos:.0f}"
+def read_chrom_sizes_cooler(path_to_cooler_file: pathlib.Path) -> Dict[str, int]:
+    return open_cooler(str(path_to_cooler_file)).chromsizes.to_dict()
 
 
-def generate_query_2d(
-    chroms,
-    weights: np.ndarray,
-    ranks: Dict[str, int],
+def generate_queries_1d(
+    rng: np.random.Generator,
+    chrom_names: Tuple[str, ...],
+    chrom_sizes: np.ndarray,
+    cum_weights: np.ndarray,
     mean_length: float,
     stddev_length: float,
-) -> Tuple[str, str]:
-    q1 = generate_query_1d(chroms, weights, mean_length, stddev_length)
-    q2 = generate_query_1d(chroms, weights, mean_length, stddev_length)
+    batch_size: int = 1024,
+) -> Iterator[str]:
+    # Queries are generated in batches to amortize the cost of calling into the PRNG
+    while True:
+        idx = np.searchsorted(cum_weights, rng.random(batch_size), side="right")
+        sizes = chrom_sizes[idx]
+
+        query_lengths = np.maximum(2.0, rng.normal(loc=mean_length, scale=stddev_length, size=batch_size))
+
+        center_pos = rng.integers(0, sizes, endpoint=True)
+        start_pos = np.maximum(0.0, center_pos - (query_lengths / 2))
+        end_pos = np.minimum(sizes, start_pos + query_lengths)
+
+        for i, start, end in zip(idx, start_pos, end_pos):
+            yield f"{chrom_names[i]}:{start:.0f}-{end:.0f}"
+
+
+def generate_query_2d(queries: Iterator[str], ranks: Dict[str, int]) -> Tuple[str, str]:
+    q1 = next(queries)
+    q2 = next(queries)
 
     chrom1, _, coord1 = q1.partition(":")
     chrom2, _, coord2 = q2.partition(":")
@@ -147,18 +165,37 @@ def generate_query_2d(
 
 
 def find_differences(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
-    df = df1.merge(
-        df2,
-        how="outer",
-        left_index=True,
-        right_index=True,
-        suffixes=("1", "2"),
+    if df1.index.equals(df2.index):
+        # Fast path: both engines returned the same pixels in the same order
+        index = df1.index
+        count1 = df1["count"].to_numpy()
+        count2 = df2["count"].to_numpy()
+        missing = None
+    else:
+        index = df1.index.intersection(df2.index)
+        count1 = df1["count"].reindex(index).to_numpy()
+        count2 = df2["count"].reindex(index).to_numpy()
+        # Pixels found in only one of the two tables are always reported as differences,
+        # regardless of their count (which may well be nan)
+        missing = df1.index.symmetric_difference(df2.index)
+
+    # Pixels whose counts are nan in both tables (e.g. masked bins) are not considered as differences
+    mask = ~np.isclose(count1, count2, equal_nan=True)
+    df = pd.DataFrame({"count1": count1[mask], "count2": count2[mask]}, index=index[mask])
+
+    if missing is None or len(missing) == 0:
+        return df
+
+    df_missing = pd.DataFrame(
+        {
+            "count1": df1["count"].reindex(missing).to_numpy(),
+            "count2": df2["count"].reindex(missing).to_numpy(),
+        },
+        index=missing,
     )
-    # We're mapping False to None so that we can more easily drop identical rows with dropna()
-    df["count_close_enough"] = pd.Series(np.isclose(df["count1"], df["count2"])).map({False: None})
-
-    # We're dropping the counts to avoid incorrectly flagging rows with nan as counts
-    return df.drop(columns=["count1", "count2"]).dropna()
+    if len(df) == 0:
+        return df_missing
+    return pd.concat([df, df_missing])
 
 
 def results_are_identical(worker_id, q1, q2, expected, found) -> bool:
@@ -190,10 +227,11 @@ def results_are_identical(worker_id, q1, q2, expected, found) -> bool:
     return True
 
 
-def seed_prng(worker_id: int, seed):
-    seed = hash(tuple([worker_id, seed]))
-    logging.info("[%d] seed: %d", worker_id, seed)
-    random.seed(seed)
+def seed_prng(worker_id: int, seed: int) -> np.random.Generator:
+    # SeedSequence only accepts non-negative integers: map negative seeds to their two's complement
+    seed_seq = np.random.SeedSequence(seed & 0xFFFFFFFFFFFFFFFF, spawn_key=(worker_id,))
+    logging.info("[%d] seed: %d (spawn key: %s)", worker_id, seed, seed_seq.spawn_key)
+    return np.random.default_rng(seed_seq)
 
 
 def hictk_open_file(path: str, resolution: int = 0):
@@ -205,8 +243,8 @@ def hictk_open_file(path: str, resolution: int = 0):
 def worker(
     path_to_file: pathlib.Path,
     path_to_reference_file: pathlib.Path,
-    chroms_flat,
-    chrom_ranks,
+    chrom_names: Tuple[str, ...],
+    chrom_sizes: np.ndarray,
     query_length_mu: float,
     query_length_std: float,
     _1d_to_2d_query_ratio: float,
@@ -221,13 +259,24 @@ def worker(
     num_queries = 0
 
     try:
-        seed_prng(worker_id, seed)
+        rng = seed_prng(worker_id, seed)
 
-        chrom_sizes = np.array([n for _, n in chroms_flat], dtype=int)
-        weights = chrom_sizes / chrom_sizes.sum()
+        chrom_ranks = {chrom: i for i, chrom in enumerate(chrom_names)}
 
-        clr = cooler.Cooler(str(path_to_reference_file))
-        sel = clr.matrix(balance=balance if balance != "NONE" else False, as_pixels=True, join=True)
+        # Computing the CDF once lets us sample chromosomes with a binary search
+        cum_weights = np.cumsum(chrom_sizes / chrom_sizes.sum())
+        cum_weights[-1] = 1.0
+
+        queries = generate_queries_1d(
+            rng,
+            chrom_names,
+            chrom_sizes,
+            cum_weights,
+            mean_length=query_length_mu,
+            stddev_length=query_length_std,
+        )
+
+        clr, sel = open_reference_cooler(str(path_to_reference_file), balance)
 
         f = hictk_open_file(str(path_to_file), clr.binsize)
 
@@ -239,21 +288,10 @@ def worker(
                 )
                 break
 
-            if _1d_to_2d_query_ratio <= random.random():
-                q1, q2 = generate_query_2d(
-                    chroms_flat,
-                    weights,
-                    chrom_ranks,
-                    mean_length=query_length_mu,
-                    stddev_length=query_length_std,
-                )
+            if _1d_to_2d_query_ratio <= rng.random():
+                q1, q2 = generate_query_2d(queries, chrom_ranks)
             else:
-                q1 = generate_query_1d(
-                    chroms_flat,
-                    weights,
-                    mean_length=query_length_mu,
-                    stddev_length=query_length_std,
-                )
+                q1 = next(queries)
                 q2 = q1
 
             num_queries += 1
@@ -285,8 +323,10 @@ def main():
 
     chroms = read_chrom_sizes_cooler(args["reference-cooler"])
 
-    chrom_ranks = {chrom: i for i, chrom in enumerate(chroms.keys())}
-    chroms_flat = list(chroms.items())
+    # Chromosomes are shipped to workers as a tuple of names plus a single array of sizes:
+    # this pickles much more compactly than a list of (name, size) pairs and a rank dict
+    chrom_names = tuple(chroms.keys())
+    chrom_sizes = np.fromiter(chroms.values(), dtype=np.int64, count=len(chroms))
 
     end_time = time.time() + args["duration"]
 
@@ -296,8 +336,8 @@ def main():
             zip(
                 itertools.repeat(args["uri"]),
                 itertools.repeat(args["reference-cooler"]),
-                itertools.repeat(chroms_flat),
-                itertools.repeat(chrom_ranks),
+                itertools.repeat(chrom_names),
+                itertools.repeat(chrom_sizes),
                 itertools.repeat(args["query_length_avg"]),
                 itertools.repeat(args["query_length_std"]),
                 itertools.repeat(args["1d_to_2d_query_ratio"]),
@@ -21,6 +21,12 @@ def make_cli():
     )
     cli.add_argument("src", type=str, help="Source path.")
     cli.add_argument("dest", type=str, help="Destination path.")
+    cli.add_argument(
+        "--copy",
+        action="store_true",
+        default=False,
+        help="Copy the source dataset instead of hard-linking it.",
+    )
 
     return cli
 
@@ -29,7 +35,11 @@ def main():
     args = vars(make_cli().parse_args())
 
     with cooler.Cooler(str(args["cooler"])).open("r+") as f:
-        f[args["dest"]] = f[args["src"]]
+        if args["copy"]:
+            # Data is copied chunk by chunk by HDF5 (H5Ocopy), without going through Python
+            f.copy(args["src"], args["dest"])
+        else:
+            f[args["dest"]] = f[args["src"]]
 
 
 if __name__ == "__main__":